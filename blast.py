@@ -2,12 +2,25 @@
 import os
 import sys
 from argparse import ArgumentParser, RawTextHelpFormatter
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from glob import glob
 from math import ceil
-from multiprocessing import Process
+from mmap import ACCESS_READ, mmap
+from queue import Queue
+from re import search
 from shutil import which
-from subprocess import DEVNULL, run
+from subprocess import DEVNULL, PIPE, Popen, run
 from tempfile import mkstemp
+from threading import Lock, Thread
+from time import sleep, strftime
+
+try: # igzip decodes several times faster than zlib when available #
+    from isal.igzip import IGzipFile as GzipFile
+except ImportError:
+    from gzip import GzipFile
+
+OUTPUT_FIELDS = ('qseqid', 'qstart', 'qend', 'qlen', 'sseqid', 'sstart', 'send', 'slen', 'pident', 'score')
 
 
 def __init__(parameters):
@@ -35,32 +48,32 @@ def __init__(parameters):
     )
 
     parser.add_argument(
-        '--makeblastdb', default = which('makeblastdb', mode = os.X_OK), type = str, required = False, metavar = 'makeblastdb',
+        '--makeblastdb', default = None, type = str, required = False, metavar = 'makeblastdb',
         help = 'Default: environmental makeblastdb.'
     )
 
     parser.add_argument(
-        '--blastn', default = which('blastn', mode = os.X_OK), type = str, required = False, metavar = 'blastn',
+        '--blastn', default = None, type = str, required = False, metavar = 'blastn',
         help = 'Default: environmental blastn.'
     )
 
     parser.add_argument(
-        '--blastp', default = which('blastp', mode = os.X_OK), type = str, required = False, metavar = 'blastp',
+        '--blastp', default = None, type = str, required = False, metavar = 'blastp',
         help = 'Default: environmental blastp.'
     )
 
     parser.add_argument(
-        '--blastx', default = which('blastx', mode = os.X_OK), type = str, required = False, metavar = 'blastx',
+        '--blastx', default = None, type = str, required = False, metavar = 'blastx',
         help = 'Default: environmental blastx.'
     )
 
     parser.add_argument(
-        '--tblastn', default = which('tblastn', mode = os.X_OK), type = str, required = False, metavar = 'tblastn',
+        '--tblastn', default = None, type = str, required = False, metavar = 'tblastn',
         help = 'Default: environmental tblastn.'
     )
 
     parser.add_argument(
-        '--tblastx', default = which('tblastx', mode = os.X_OK), type = str, required = False, metavar = 'tblastx',
+        '--tblastx', default = None, type = str, required = False, metavar = 'tblastx',
         help = 'Default: environmental tblastx.'
     )
 
@@ -69,6 +82,11 @@ def __init__(parameters):
         help = 'Default: {0}.'.format(os.cpu_count())
     )
 
+    parser.add_argument(
+        '--shard_factor', type = int, default = 4, required = False, metavar = 'shard_factor',
+        help = 'Split the query into shard_factor * threads shards so fast workers can steal work.\nDefault: 4.'
+    )
+
     parser.add_argument(
         '--strand', type = str, default = 'both', required = False, choices = ('both', 'minus', 'plus'), metavar = 'both|minus|plus',
         help = 'Default: both.'
@@ -82,12 +100,70 @@ def __init__(parameters):
     return parser.parse_args(parameters)
 
 
+def timestamp():
+    return strftime('%Y-%m-%d %H:%M:%S')
+
+
 def make_file():
-    file_descriptor, file_name = mkstemp(dir = os.getcwd())
+    # prefer ram-backed or dedicated scratch space over the working directory #
+    directory = os.environ.get('TMPDIR')
+    if directory is None and os.path.isdir('/dev/shm'):
+        directory = '/dev/shm'
+    file_descriptor, file_name = mkstemp(dir = directory if directory else os.getcwd())
     os.close(file_descriptor)
     return file_name
 
 
+def fadvise(file_descriptor, *advices):
+    if hasattr(os, 'posix_fadvise'):
+        advice = 0
+        for name in advices:
+            advice |= getattr(os, name)
+        os.posix_fadvise(file_descriptor, 0, 0, advice)
+    return None
+
+
+def copy_range(input_descriptor, output_descriptor, start, length):
+    if hasattr(os, 'copy_file_range'): # kernel to kernel, no user copy #
+        try:
+            while length:
+                copied = os.copy_file_range(input_descriptor, output_descriptor, length, offset_src = start)
+                if not copied:
+                    break
+                start += copied
+                length -= copied
+        except OSError:
+            pass
+        if not length:
+            return None
+    if hasattr(os, 'sendfile'):
+        try:
+            while length:
+                copied = os.sendfile(output_descriptor, input_descriptor, start, length)
+                if not copied:
+                    break
+                start += copied
+                length -= copied
+        except OSError:
+            pass
+        if not length:
+            return None
+    os.lseek(input_descriptor, start, os.SEEK_SET)
+    while length:
+        block = os.read(input_descriptor, min(length, 8 * 1024 ** 2))
+        if not block:
+            break
+        os.write(output_descriptor, block)
+        length -= len(block)
+    return None
+
+
+def blast_version(blast):
+    run_process = run([blast, '-version'], capture_output = True)
+    match = search(rb'(\d+)\.(\d+)', run_process.stdout)
+    return (int(match.group(1)), int(match.group(2))) if match else (0, 0)
+
+
 def run_makeblastdb(makeblastdb, dbtype, input_fasta):
     output_blastdb = make_file()
     run_process = run(
@@ -98,122 +174,350 @@ def run_makeblastdb(makeblastdb, dbtype, input_fasta):
     return output_blastdb
 
 
+def scan_records(open_input, block_size = 1024 ** 2):
+    # block-at-a-time boundary scan for any binary stream, one find call per boundary #
+    offset = 0
+    previous_byte = b'\n'
+    while True:
+        block = open_input.read(block_size)
+        if not block:
+            break
+        if previous_byte == b'\n' and block[0 : 1] == b'>':
+            yield offset
+        position = block.find(b'\n>')
+        while position != -1:
+            yield offset + position + 1
+            position = block.find(b'\n>', position + 1)
+        previous_byte = block[-1 : ]
+        offset += len(block)
+    return None
+
+
+def count_records(open_input, input_mmap):
+    if input_mmap is not None:
+        record_count = 1 if input_mmap[0 : 1] == b'>' else 0
+        position = 0
+        while True:
+            position = input_mmap.find(b'\n>', position)
+            if position == -1:
+                break
+            record_count += 1
+            position += 1
+    else:
+        record_count = sum(1 for position in scan_records(open_input))
+        open_input.seek(0, 0)
+    return record_count
+
+
+def record_positions(open_input, input_mmap):
+    if input_mmap is not None:
+        if input_mmap[0 : 1] == b'>':
+            yield 0
+        position = 0
+        while True:
+            position = input_mmap.find(b'\n>', position)
+            if position == -1:
+                break
+            yield position + 1
+            position += 1
+    else: # mmap is unavailable #
+        yield from scan_records(open_input)
+    return None
+
+
+def split_gzip_fasta(open_input, n, shard_queue):
+    # single decompression pass, records dealt round-robin for balanced shards #
+    open_gzip = GzipFile(fileobj = open_input)
+    output_files = [make_file() for index in range(n)]
+    output_handles = [open(output_file, 'wb') for output_file in output_files]
+    record_index = -1
+    previous_byte = b'\n'
+    while True:
+        block = open_gzip.read(1024 ** 2)
+        if not block:
+            break
+        boundaries = list()
+        if previous_byte == b'\n' and block[0 : 1] == b'>':
+            boundaries.append(0)
+        position = block.find(b'\n>')
+        while position != -1:
+            boundaries.append(position + 1)
+            position = block.find(b'\n>', position + 1)
+        cursor = 0
+        for boundary in boundaries:
+            if record_index >= 0 and cursor < boundary:
+                output_handles[record_index % n].write(block[cursor : boundary])
+            cursor = boundary
+            record_index += 1
+        if record_index >= 0 and cursor < len(block):
+            output_handles[record_index % n].write(block[cursor : ])
+        previous_byte = block[-1 : ]
+    open_gzip.close()
+    for output_handle in output_handles:
+        output_handle.close()
+    for output_file in output_files:
+        if os.path.getsize(output_file):
+            shard_queue.put(output_file)
+        else:
+            os.remove(output_file)
+    return None
+
+
+def scan_shards(input_file, n, shard_queue):
+    try:
+        open_input = open(input_file, 'rb')
+        fadvise(open_input.fileno(), 'POSIX_FADV_SEQUENTIAL', 'POSIX_FADV_WILLNEED')
+        if open_input.read(2) == b'\x1f\x8b': # gzipped query #
+            open_input.seek(0, 0)
+            split_gzip_fasta(open_input, n, shard_queue)
+        else:
+            open_input.seek(0, 0)
+            try:
+                input_mmap = mmap(open_input.fileno(), 0, access = ACCESS_READ)
+            except (OSError, ValueError):
+                input_mmap = None
+            input_size = os.fstat(open_input.fileno()).st_size
+            step = ceil(count_records(open_input, input_mmap) / n) if input_size else 0
+            shard_start = None
+            shard_records = 0
+            for position in record_positions(open_input, input_mmap):
+                if shard_start is None:
+                    shard_start = position
+                    shard_records = 1
+                elif shard_records == step:
+                    shard_queue.put((shard_start, position - shard_start))
+                    shard_start = position
+                    shard_records = 1
+                else:
+                    shard_records += 1
+            if shard_start is not None and shard_start < input_size:
+                shard_queue.put((shard_start, input_size - shard_start))
+            if input_mmap is not None:
+                input_mmap.close()
+        open_input.close()
+    except Exception as error: # hand the failure to the consumer instead of yielding an empty split #
+        shard_queue.put(error)
+    else:
+        shard_queue.put(None)
+    return None
+
+
 def split_fasta(input_file, n):
-    position_list = list()
-    open_input = open(input_file, 'rb')
+    # scan boundaries in the background so workers can start on early shards #
+    shard_queue = Queue(maxsize = n)
+    scan_thread = Thread(target = scan_shards, args = (input_file, n, shard_queue), daemon = True)
+    scan_thread.start()
     while True:
-        line = open_input.readline()
-        if line.startswith(b'>'):
-            position_list.append(open_input.tell() - len(line))
-        if not line:
-            position_list.append(open_input.tell())
+        shard = shard_queue.get()
+        if shard is None:
             break
-    step = ceil((len(position_list) - 1) / n)
-    position_list_index = 0
+        if isinstance(shard, Exception):
+            scan_thread.join()
+            raise shard
+        yield shard
+    scan_thread.join()
+    return None
+
+
+def write_lines(output_descriptor, output_lock, block):
+    # flush complete lines only, so shard outputs never interleave mid-line #
+    index = block.rfind(b'\n')
+    if index == -1:
+        return block
+    with output_lock:
+        os.write(output_descriptor, block[ : index + 1])
+    return block[index + 1 : ]
+
+
+def run_blast_thread(command, query_descriptor, query_shard, output_file, output_descriptor, output_lock):
+    if isinstance(query_shard, tuple): # an (offset, size) range fed through stdin #
+        query_offset, query_size = query_shard
+        process = Popen(
+            command + ['-query', '-', '-out', output_file],
+            stdin = PIPE, stdout = DEVNULL, stderr = DEVNULL, close_fds = True, start_new_session = True
+        )
+        os.set_blocking(process.stdin.fileno(), False)
+    else: # an on-disk shard written by the gzip splitter #
+        query_size = 0
+        process = Popen(
+            command + ['-query', query_shard, '-out', output_file],
+            stdout = DEVNULL, stderr = DEVNULL, close_fds = True, start_new_session = True
+        )
+    # feed the query shard and splice results while blast is still running #
+    input_descriptor = os.open(output_file, os.O_RDONLY | os.O_NONBLOCK)
+    tail = b''
     while True:
-        positions = position_list[position_list_index : position_list_index + step + 1]
-        if len(positions) <= 1:
+        busy_marker = False
+        if query_size:
+            try:
+                block_size = os.write(process.stdin.fileno(), os.pread(query_descriptor, min(query_size, 65536), query_offset))
+                query_offset += block_size
+                query_size -= block_size
+                busy_marker = True
+            except BlockingIOError:
+                pass
+            except BrokenPipeError:
+                query_size = 0
+            if not query_size:
+                process.stdin.close()
+        try:
+            block = os.read(input_descriptor, 65536)
+        except BlockingIOError:
+            block = None
+        if block:
+            tail = write_lines(output_descriptor, output_lock, tail + block)
+            busy_marker = True
+        elif not query_size and process.poll() is not None:
+            break
+        if not busy_marker:
+            sleep(0.01)
+    while True: # drain bytes written between the last read and process exit #
+        try:
+            block = os.read(input_descriptor, 65536)
+        except BlockingIOError:
+            break
+        if not block:
             break
-        output_file = make_file()
-        open_input.seek(positions[0], 0)
-        open_output = open(output_file, 'wb')
-        open_output.write(open_input.read(positions[-1] - positions[0]))
-        open_output.close()
-        yield (output_file)
-        position_list_index += step
-    open_input.close()
+        tail = write_lines(output_descriptor, output_lock, tail + block)
+    if tail:
+        with output_lock:
+            os.write(output_descriptor, tail)
+    os.close(input_descriptor)
+    assert not process.returncode, 'An error has occured while running blast.'
+    if isinstance(query_shard, str):
+        os.remove(query_shard)
+    os.remove(output_file)
     return None
 
 
-def run_blast_thread(command, input_file, output_file):
-    run_process = run(
-        command + ['-query', input_file, '-out', output_file],
-        stdout = DEVNULL, stderr = DEVNULL
-    )
-    assert not run_process.returncode, 'An error has occured while running blast.'
-    os.remove(input_file)
+def make_output():
+    output_file = make_file()
+    if hasattr(os, 'mkfifo'): # a named pipe keeps shard results off the disk #
+        os.remove(output_file)
+        os.mkfifo(output_file)
+    return output_file
+
+
+def warm_blastdb(blastdb_prefix):
+    # prime the page cache once so all blast workers share warm pages #
+    for input_file in glob(blastdb_prefix + '.*'):
+        open_input = open(input_file, 'rb')
+        fadvise(open_input.fileno(), 'POSIX_FADV_WILLNEED')
+        while open_input.read(1024 ** 2):
+            pass
+        open_input.close()
     return None
 
 
 def remove_blastdb(blastdb_prefix):
-    open_directory = os.scandir(path = os.getcwd())
-    for entry in open_directory:
-        if entry.is_file() and entry.path.startswith(blastdb_prefix):
-            os.remove(entry.path)
-    open_directory.close()
+    # the prefix is a unique mkstemp name in scratch space, so the glob only matches database files #
+    for input_file in glob(blastdb_prefix + '.*'):
+        os.remove(input_file)
+    try:
+        os.remove(blastdb_prefix)
+    except FileNotFoundError:
+        pass
     return None
 
 
 def combine(input_files, output_file):
-    open_output = open(output_file, 'wb')
-    header = '\t'.join(['qseqid', 'qstart', 'qend', 'qlen', 'sseqid', 'sstart', 'send', 'slen', 'pident', 'score'])
-    open_output.write(header.encode() + b'\n')
+    header = '\t'.join(OUTPUT_FIELDS).encode() + b'\n'
+    output_descriptor = os.open(output_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    if hasattr(os, 'posix_fallocate'): # contiguous extents for the whole result #
+        try:
+            os.posix_fallocate(output_descriptor, 0, len(header) + sum(os.path.getsize(input_file) for input_file in input_files))
+        except OSError:
+            pass
+    os.write(output_descriptor, header)
     for input_file in input_files:
-        open_input = open(input_file, 'rb')
-        while True:
-            if not open_output.write(open_input.read(1024 ** 3)):
-                break
-        open_input.close()
+        input_descriptor = os.open(input_file, os.O_RDONLY)
+        fadvise(input_descriptor, 'POSIX_FADV_SEQUENTIAL')
+        copy_range(input_descriptor, output_descriptor, 0, os.fstat(input_descriptor).st_size)
+        os.close(input_descriptor)
         os.remove(input_file)
-    open_output.close()
+    os.close(output_descriptor)
     return None
 
 
 if '__main__' == __name__:
     parameters = __init__(sys.argv[1 : ])
 
-    assert parameters.makeblastdb and os.access(parameters.makeblastdb, os.X_OK), '"--makeblastdb" should be specified.'
-    assert parameters.blastn and os.access(parameters.blastn, os.X_OK), '"--blastn" should be specified.'
-    assert parameters.blastp and os.access(parameters.blastp, os.X_OK), '"--blastp" should be specified.'
-    assert parameters.blastx and os.access(parameters.blastx, os.X_OK), '"--blastx" should be specified.'
-    assert parameters.tblastn and os.access(parameters.tblastn, os.X_OK), '"--tblastn" should be specified.'
-    assert parameters.tblastx and os.access(parameters.tblastx, os.X_OK), '"--tblastx" should be specified.'
+    # resolve only the binaries this run needs, one PATH scan per tool #
+    which_cached = lru_cache(maxsize = None)(which)
+    for tool in ('makeblastdb', parameters.function):
+        if getattr(parameters, tool) is None:
+            setattr(parameters, tool, which_cached(tool, mode = os.X_OK))
+        assert getattr(parameters, tool) and os.access(getattr(parameters, tool), os.X_OK), '"--{0}" should be specified.'.format(tool)
 
-    if os.access(parameters.target, os.R_OK): # fasta file #
+    if any(os.path.exists(parameters.target + suffix) for suffix in ('.nhr', '.phr', '.nal', '.pal', '.ndb', '.pdb')): # prebuilt database prefix #
+        makeblastdb_marker = False
+    elif os.access(parameters.target, os.R_OK): # fasta file #
         makeblastdb_marker = True
         dbtype = r'nucl' if parameters.function in (r'blastn', r'tblastn', r'tblastx') else r'prot'
-        print(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), '->', 'Making database for blast.', flush = True)
+        print(timestamp(), '->', 'Making database for blast.', flush = True)
         parameters.target = run_makeblastdb(parameters.makeblastdb, dbtype, parameters.target)
-        print(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), '->', 'Done.', flush = True)
+        print(timestamp(), '->', 'Done.', flush = True)
     else:
         makeblastdb_marker = False
 
     command = [
-        parameters.function, '-db', parameters.target, '-num_threads', '1',
-        '-outfmt', '6 qseqid qstart qend qlen sseqid sstart send slen pident score',
+        getattr(parameters, parameters.function), '-db', parameters.target,
+        '-outfmt', '6 ' + ' '.join(OUTPUT_FIELDS),
     ]
 
     # construct blast command #
-    if parameters.function == 'blastn':
-        command.extend(['-strand', parameters.strand])
-    elif parameters.function == 'blastx':
-        command.extend(['-strand', parameters.strand, '-query_gencode', str(parameters.codon_table)])
-    elif parameters.function == 'tblastx':
-        command.extend(['-strand', parameters.strand, '-db_gencode', str(parameters.codon_table), '-query_gencode', str(parameters.codon_table)])
-    elif parameters['function'] == 'tblastn':
-        command.extend(['-db_gencode', str(parameters.codon_table)])
+    function_options = {
+        'blastn': ['-strand', parameters.strand],
+        'blastx': ['-strand', parameters.strand, '-query_gencode', str(parameters.codon_table)],
+        'tblastn': ['-db_gencode', str(parameters.codon_table)],
+        'tblastx': ['-strand', parameters.strand, '-db_gencode', str(parameters.codon_table), '-query_gencode', str(parameters.codon_table)],
+    }
+    command.extend(function_options.get(parameters.function, []))
 
     # run blast #
-    print(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), '->', 'Running blast.', flush = True)
-    process_list = list()
+    print(timestamp(), '->', 'Running blast.', flush = True)
     output_list = list()
-    for query_file in split_fasta(parameters.query, parameters.threads):
+    with open(parameters.query, 'rb') as open_query:
+        gzip_marker = open_query.read(2) == b'\x1f\x8b'
+    if not gzip_marker and blast_version(getattr(parameters, parameters.function)) >= (2, 15): # native batch threading, no query splitting #
         output_list.append(make_file())
-        process_list.append(
-            Process(
-                target = run_blast_thread,
-                args = (command, query_file, output_list[-1]),
-            )
+        run_process = run(
+            command + ['-num_threads', str(parameters.threads), '-mt_mode', '1', '-query', parameters.query, '-out', output_list[-1]],
+            stdout = DEVNULL, stderr = DEVNULL
         )
-    for process in process_list:
-        process.start()
-    for process in process_list:
-        process.join()
-    print(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), '->', 'Done.', flush = True)
+        assert not run_process.returncode, 'An error has occured while running blast.'
+    else:
+        warm_blastdb(parameters.target)
+        output_descriptor = os.open(parameters.output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        if hasattr(os, 'posix_fallocate'): # heuristic size, extents stay contiguous under parallel splicing #
+            try:
+                os.posix_fallocate(output_descriptor, 0, os.path.getsize(parameters.query) * 2)
+            except OSError:
+                pass
+        os.write(output_descriptor, '\t'.join(OUTPUT_FIELDS).encode() + b'\n')
+        output_lock = Lock()
+        query_descriptor = os.open(parameters.query, os.O_RDONLY)
+        executor = ThreadPoolExecutor(max_workers = parameters.threads)
+        future_list = list()
+        for query_shard in split_fasta(parameters.query, parameters.shard_factor * parameters.threads):
+            future_list.append(
+                executor.submit(
+                    run_blast_thread, command + ['-num_threads', '1'],
+                    query_descriptor, query_shard, make_output(), output_descriptor, output_lock
+                )
+            )
+        for future in future_list:
+            future.result()
+        executor.shutdown()
+        os.close(query_descriptor)
+        os.ftruncate(output_descriptor, os.lseek(output_descriptor, 0, os.SEEK_CUR))
+        os.close(output_descriptor)
+    print(timestamp(), '->', 'Done.', flush = True)
 
     if makeblastdb_marker:
         remove_blastdb(parameters.target)
 
-    combine(output_list, parameters.output)
+    if output_list: # the mt_mode fast path; legacy shards are spliced as they arrive #
+        combine(output_list, parameters.output)
 
-    print(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), '->', 'Finished.', flush = True)
+    print(timestamp(), '->', 'Finished.', flush = True)